@@ -1,5 +1,7 @@
 #!/usr/bin/env python
+import base64
 import os
+from itertools import groupby
 
 import pandas as pd
 import torch
@@ -10,37 +12,129 @@ from transformers import AutoTokenizer, EsmForProteinFolding
 os.environ["PT_HPU_ENABLE_H2D_DYNAMIC_SLICE"] = "0"
 os.environ["PT_HPU_ENABLE_REFINE_DYNAMIC_SHAPES"] = "1"
 
+_PAD_MULTIPLE = 32
+# Keep fp32 weights under bf16 autocast so the structure module frames
+# and atom positions are not computed or stored in bf16
+_DTYPE = torch.bfloat16
+_HOST_KEYS = ("aatype", "atom37_atom_exists", "residx_atom37_to_atom14",
+              "residue_index", "plddt")
+
+_TOK = None
+_MODEL = None
+
+
+def _get_model(device):
+    # Load the tokenizer and model once per process and reuse them
+    global _TOK, _MODEL
+    if _MODEL is None:
+        _TOK = AutoTokenizer.from_pretrained("facebook/esmfold_v1")
+        _MODEL = EsmForProteinFolding.from_pretrained(
+            "facebook/esmfold_v1",
+            low_cpu_mem_usage=True,
+        ).to(device).eval()
+    return _TOK, _MODEL
+
+
+def _length_batches(sequences, max_tokens):
+    # Group sequences that pad to the same length so each forward pass
+    # sees only a few distinct input shapes, and cap each batch at
+    # max_tokens padded residues so long sequences fold one at a time
+    if not all(sequences):
+        raise ValueError("Cannot fold an empty sequence")
+    order = sorted(range(len(sequences)), key=lambda j: len(sequences[j]))
+    batches = []
+    for bucket, group in groupby(order, key=lambda j: -(-len(sequences[j]) // _PAD_MULTIPLE)):
+        group = list(group)
+        batch_size = max(1, max_tokens // (bucket * _PAD_MULTIPLE))
+        for start in range(0, len(group), batch_size):
+            batches.append(group[start:start + batch_size])
+    return batches
+
+
+def _to_host(tensors):
+    # Copy the tensors off the device with a single synchronise, then
+    # upcast on the host so they convert to numpy
+    host = {k: v.to("cpu", non_blocking=True) for k, v in tensors.items()}
+    torch.hpu.synchronize()
+    return {k: v.float() if v.is_floating_point() else v for k, v in host.items()}
+
+
+def _batch_ptm(logits, mask, lengths, no_bins, max_bin=31, eps=1e-8):
+    # pTM over each sequence's real residues, as in compute_tm, but on the
+    # padded logits with the attention mask so shapes stay static and
+    # nothing synchronises with the host
+    boundaries = torch.linspace(0, max_bin, steps=no_bins - 1, device=logits.device)
+    step = boundaries[1] - boundaries[0]
+    bin_centers = torch.cat([boundaries + step / 2, boundaries[-1:] + 3 * step / 2])
+    d0 = torch.tensor([1.24 * (max(n, 19) - 15) ** (1.0 / 3) - 1.8 for n in lengths])
+    d0 = d0.to(logits.device, non_blocking=True)
+    tm_per_bin = 1.0 / (1 + bin_centers ** 2 / d0[:, None] ** 2)
+
+    probs = torch.softmax(logits.float(), dim=-1)
+    tm_term = torch.einsum("bijk,bk->bij", probs, tm_per_bin)
+    mask = mask.float()
+    per_alignment = (tm_term * mask[:, None, :]).sum(-1) / (eps + mask.sum(-1, keepdim=True))
+    return per_alignment.masked_fill(mask == 0, float("-inf")).max(dim=-1).values
+
+
+def fold_sequences_esm(sequences, device, max_tokens=1024):
+    tok, model = _get_model(device)
+
+    results = [None] * len(sequences)
+    for batch in _length_batches(sequences, max_tokens):
+        inputs = tok([sequences[j] for j in batch],
+                     padding=True,
+                     pad_to_multiple_of=_PAD_MULTIPLE,
+                     return_tensors="pt",
+                     add_special_tokens=False)
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+
+        with torch.inference_mode():
+            with torch.autocast(device_type=device.type, dtype=_DTYPE):
+                out = model(**inputs)
+            # Compute pTM on the device, so the (B, L, L, 64) logits never leave it
+            ptm = _batch_ptm(out["ptm_logits"],
+                             inputs["attention_mask"],
+                             [len(sequences[j]) for j in batch],
+                             model.distogram_bins)
+        # Only the final structure module iteration is needed for the PDB
+        host = _to_host({"positions": out["positions"][-1:],
+                         "ptm": ptm,
+                         **{key: out[key] for key in _HOST_KEYS}})
+
+        for k, j in enumerate(batch):
+            n = len(sequences[j])
+            # Trim the padding before building the PDB so the closing TER
+            # record names the last real residue
+            item = {key: host[key][k:k + 1, :n] for key in _HOST_KEYS}
+            item["positions"] = host["positions"][:, k:k + 1, :n]
+            pdb_str = model.output_to_pdb(item)[0]
+
+            # Extract pLDDT (per-residue confidence) and pTM (predicted TM-score)
+            plddt = item["plddt"][0].numpy()
+            ptm = host["ptm"][k].numpy()
+            results[j] = (plddt, ptm, pdb_str)
+    return results
+
+
 if __name__ == "__main__":
     adapt_transformers_to_gaudi()
     device = torch.device("hpu")
-    sequence = "MGAGASAEEKHSRELEKKLK"
-    fileout = "tmp.pdb"
+    sequences = ["MGAGASAEEKHSRELEKKLK"]
     resout = "tmp.csv"
 
-    tok = AutoTokenizer.from_pretrained("facebook/esmfold_v1")
-    model = EsmForProteinFolding.from_pretrained(
-        "facebook/esmfold_v1",
-        low_cpu_mem_usage=True,
-    ).to(device).eval()
-
-    inputs = tok([sequence],
-                 return_tensors="pt",
-                 add_special_tokens=False)
-    inputs = {k: v.to(device) for k, v in inputs.items()}
-
-    with torch.no_grad(), torch.cuda.amp.autocast(enabled=device.type == device):
-        out = model(**inputs)
-        pdb_str = model.infer_pdb(sequence)
-
-    # Write the folded structure to the output PDB file
-    with open(fileout, "w") as f:
-        f.write(pdb_str)
+    results = fold_sequences_esm(sequences, device)
 
-    # Extract pLDDT (per-residue confidence) and pTM (predicted TM-score)
-    plddt = out.plddt[0].cpu().numpy()
-    ptm = out.ptm.cpu().numpy()
+    rows = []
+    for j, (sequence, (plddt, ptm, pdb_str)) in enumerate(zip(sequences, results)):
+        # Write the folded structure to the output PDB file
+        with open(f"tmp_{j}.pdb", "w") as f:
+            f.write(pdb_str)
+        # Store pLDDT as base64 float32 bytes; decode with
+        # np.frombuffer(base64.b64decode(s), dtype=np.float32).reshape(-1, 37)
+        rows.append({"sequence": sequence,
+                     "pLDDT": base64.b64encode(plddt.astype("float32").tobytes()).decode(),
+                     "pTM": float(ptm)})
     # convert to dataframe and save to csv
-    df = pd.DataFrame([{"sequence": sequence,
-                        "pLDDT": plddt,
-                        "pTM": float(ptm)}])
+    df = pd.DataFrame(rows)
     df.to_csv(resout, index=False)
@@ -1,32 +1,134 @@
 #!/usr/bin/env python
+from itertools import groupby
+
 import torch
 from transformers import AutoTokenizer, EsmForProteinFolding
 
+_PAD_MULTIPLE = 32
+# fp16 overflows in the folding trunk, so the A100 runs fp32 weights
+# under bf16 autocast rather than an fp16 model
+_DTYPE = torch.bfloat16
+_HOST_KEYS = ("aatype", "atom37_atom_exists", "residx_atom37_to_atom14",
+              "residue_index", "plddt")
+
+_TOK = None
+_MODEL = None
+
+
+def get_device():
+    # Fail loudly rather than silently folding on the CPU
+    if not torch.cuda.is_available():
+        raise RuntimeError("GPU not available")
+    return torch.device("cuda")
+
+
+def _get_model(device):
+    # Load the tokenizer and model once per process and reuse them
+    global _TOK, _MODEL
+    if _MODEL is None:
+        # Allow TF32 matmuls on A100 for the ops that stay in fp32
+        torch.set_float32_matmul_precision("high")
+        _TOK = AutoTokenizer.from_pretrained("facebook/esmfold_v1")
+        _MODEL = EsmForProteinFolding.from_pretrained(
+            "facebook/esmfold_v1",
+            low_cpu_mem_usage=True,
+        ).to(device).eval()
+    return _TOK, _MODEL
+
+
+def _length_batches(sequences, max_tokens):
+    # Group sequences that pad to the same length so each forward pass
+    # sees only a few distinct input shapes, and cap each batch at
+    # max_tokens padded residues so long sequences fold one at a time
+    if not all(sequences):
+        raise ValueError("Cannot fold an empty sequence")
+    order = sorted(range(len(sequences)), key=lambda j: len(sequences[j]))
+    batches = []
+    for bucket, group in groupby(order, key=lambda j: -(-len(sequences[j]) // _PAD_MULTIPLE)):
+        group = list(group)
+        batch_size = max(1, max_tokens // (bucket * _PAD_MULTIPLE))
+        for start in range(0, len(group), batch_size):
+            batches.append(group[start:start + batch_size])
+    return batches
+
+
+def _to_host(tensors):
+    # Copy the tensors into pinned host buffers with a single synchronise,
+    # then upcast on the host so they convert to numpy
+    host = {}
+    for k, v in tensors.items():
+        host[k] = torch.empty(v.shape, dtype=v.dtype, pin_memory=True)
+        host[k].copy_(v, non_blocking=True)
+    torch.cuda.synchronize()
+    return {k: v.float() if v.is_floating_point() else v for k, v in host.items()}
+
+
+def _batch_ptm(logits, mask, lengths, no_bins, max_bin=31, eps=1e-8):
+    # pTM over each sequence's real residues, as in compute_tm, but on the
+    # padded logits with the attention mask so shapes stay static and
+    # nothing synchronises with the host
+    boundaries = torch.linspace(0, max_bin, steps=no_bins - 1, device=logits.device)
+    step = boundaries[1] - boundaries[0]
+    bin_centers = torch.cat([boundaries + step / 2, boundaries[-1:] + 3 * step / 2])
+    d0 = torch.tensor([1.24 * (max(n, 19) - 15) ** (1.0 / 3) - 1.8 for n in lengths])
+    d0 = d0.to(logits.device, non_blocking=True)
+    tm_per_bin = 1.0 / (1 + bin_centers ** 2 / d0[:, None] ** 2)
+
+    probs = torch.softmax(logits.float(), dim=-1)
+    tm_term = torch.einsum("bijk,bk->bij", probs, tm_per_bin)
+    mask = mask.float()
+    per_alignment = (tm_term * mask[:, None, :]).sum(-1) / (eps + mask.sum(-1, keepdim=True))
+    return per_alignment.masked_fill(mask == 0, float("-inf")).max(dim=-1).values
+
+
+def fold_sequences_esm(sequences, device, max_tokens=1024):
+    tok, model = _get_model(device)
+
+    results = [None] * len(sequences)
+    for batch in _length_batches(sequences, max_tokens):
+        inputs = tok([sequences[j] for j in batch],
+                     padding=True,
+                     pad_to_multiple_of=_PAD_MULTIPLE,
+                     return_tensors="pt",
+                     add_special_tokens=False)
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+
+        with torch.inference_mode():
+            with torch.autocast(device_type=device.type, dtype=_DTYPE):
+                out = model(**inputs)
+            # Compute pTM on the device, so the (B, L, L, 64) logits never leave it
+            ptm = _batch_ptm(out["ptm_logits"],
+                             inputs["attention_mask"],
+                             [len(sequences[j]) for j in batch],
+                             model.distogram_bins)
+        # Only the final structure module iteration is needed for the PDB
+        host = _to_host({"positions": out["positions"][-1:],
+                         "ptm": ptm,
+                         **{key: out[key] for key in _HOST_KEYS}})
+
+        for k, j in enumerate(batch):
+            n = len(sequences[j])
+            # Trim the padding before building the PDB so the closing TER
+            # record names the last real residue
+            item = {key: host[key][k:k + 1, :n] for key in _HOST_KEYS}
+            item["positions"] = host["positions"][:, k:k + 1, :n]
+            pdb_str = model.output_to_pdb(item)[0]
+
+            # Extract pLDDT (per-residue confidence) and pTM (predicted TM-score)
+            plddt = item["plddt"][0].numpy()
+            ptm = host["ptm"][k].numpy()
+            results[j] = (plddt, ptm, pdb_str)
+    return results
+
+
 if __name__ == "__main__":
-    device = torch.device("gpu")
-    sequence = "MGAGASAEEKHSRELEKKLK"
-    fileout = "tmp.pdb"
-
-    tok = AutoTokenizer.from_pretrained("facebook/esmfold_v1")
-    model = EsmForProteinFolding.from_pretrained(
-        "facebook/esmfold_v1",
-        low_cpu_mem_usage=True,
-    ).to(device).eval()
-
-    inputs = tok([sequence],
-                 return_tensors="pt",
-                 add_special_tokens=False)
-    inputs = {k: v.to(device) for k, v in inputs.items()}
-
-    with torch.no_grad(), torch.cuda.amp.autocast(enabled=device.type == device):
-        out = model(**inputs)
-        pdb_str = model.infer_pdb(sequence)
-
-    # Write the folded structure to the output PDB file
-    with open(fileout, "w") as f:
-        f.write(pdb_str)
-
-    # Extract pLDDT (per-residue confidence) and pTM (predicted TM-score)
-    plddt = out.plddt[0].cpu().numpy()
-    ptm = out.ptm.cpu().numpy()
-    print(plddt.mean(), ptm)
+    device = get_device()
+    sequences = ["MGAGASAEEKHSRELEKKLK"]
+
+    results = fold_sequences_esm(sequences, device)
+
+    for j, (plddt, ptm, pdb_str) in enumerate(results):
+        # Write the folded structure to the output PDB file
+        with open(f"tmp_{j}.pdb", "w") as f:
+            f.write(pdb_str)
+        print(plddt.mean(), ptm)
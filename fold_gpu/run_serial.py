@@ -1,36 +1,40 @@
+import base64
+import multiprocessing
 import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 
 import monsterproteinstability as mps
+from run_esmfold import fold_sequences_esm, get_device
+
+ANALYSIS_COLUMNS = ["Radius_of_Gyration", "RMSD", "PDB_MD", "SASA", "3DI",
+                    "P-SEA", "Protein_Blocks", "DSSP"]
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                   "OPENMM_CPU_THREADS"]
 
 
 def bulk_fold(file):
     entries, descriptions = mps.load_fasta_entries(file)
     print(f"FASTA entries: {entries}", flush=True)
 
-    results = []
-    for j, entry in enumerate(entries):
-        print(f"Working on entry # {j}", flush=True)
-        # Fold the sequence using ESM
-        plddt, ptm = mps.fold_sequence_esm(entry)
+    # Fold the sequences using ESM, keeping the pdb text in memory
+    folds = fold_sequences_esm(entries, get_device())
 
-        # Load the pdb file and add it to the results
-        with open("tmp.pdb", "r") as f:
-            pdb_str = f.read()
-
-        # Collect the results in a list
+    results = []
+    for j, (entry, (plddt, ptm, pdb_str)) in enumerate(zip(entries, folds)):
+        # Collect the results in a list, storing pLDDT as base64 float32 bytes;
+        # decode with np.frombuffer(base64.b64decode(s), dtype=np.float32).reshape(-1, 37)
         results.append({
             "Description": descriptions[j],
             "Sequence": entry,
-            "pTM_Score": ptm,
-            "pLDDT_Score": plddt,
+            "pTM_Score": float(ptm),
+            "pLDDT_Score": base64.b64encode(plddt.astype("float32").tobytes()).decode(),
             "Mean_pLDDT_Score": plddt.mean(),
             "PDB": pdb_str,
         })
-        # Safely remove the temporary file
-        if os.path.exists("tmp.pdb"):
-            os.remove("tmp.pdb")
 
     # Create the dataframe after processing all entries
     df = pd.DataFrame(results)
@@ -40,22 +44,14 @@ def bulk_fold(file):
     return df
 
 
-def bulk_analysis(file):
-    df = pd.read_csv(file)
-
-    # Add columns for analysis results
-    df["Radius_of_Gyration"] = None
-    df["RMSD"] = None
-    df["PDB_MD"] = None
-    df["SASA"] = None
-    df["3DI"] = None
-    df["P-SEA"] = None
-    df["Protein_Blocks"] = None
-    df["DSSP"] = None
-
-    for i in range(len(df)):
-        print(f"Analyzing entry # {i}", flush=True)
-        pdb_str = df.loc[i, "PDB"]
+def _analyze_entry(i, pdb_str):
+    print(f"Analyzing entry # {i}", flush=True)
+    # Work in a private directory so parallel workers do not clash on
+    # tmp.pdb, output.pdb and md_log.txt
+    cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp()
+    os.chdir(tmp_dir)
+    try:
         with open("tmp.pdb", "w") as f:
             f.write(pdb_str)
         mps.md_workflow("tmp.pdb")
@@ -63,9 +59,6 @@ def bulk_analysis(file):
         rad_gyr = mps.get_radius_gyration_time("output.pdb")
         rmsd = mps.get_rmsd_time("output.pdb", "tmp.pdb")
 
-        df.at[i, "Radius_of_Gyration"] = rad_gyr
-        df.at[i, "RMSD"] = rmsd
-
         # Save a stripped version of the pdb
         mps.save_stripped_pdb("output.pdb", f"output.pdb")
 
@@ -73,17 +66,50 @@ def bulk_analysis(file):
         with open("output.pdb", "r") as f:
             pdb_str = f.read()
 
-        df.at[i, "PDB_MD"] = pdb_str
-        df.at[i, "SASA"] = mps.calc_sasa("output.pdb")
-        df.at[i, "3DI"] = mps.get_3di_sequence("output.pdb")
-        df.at[i, "P-SEA"] = mps.get_p_sea_sequence("output.pdb")
-        df.at[i, "Protein_Blocks"] = mps.get_protein_blocks_sequence("output.pdb")
-        df.at[i, "DSSP"] = mps.get_dssp_sequence("output.pdb")
-
+        return {
+            "Radius_of_Gyration": rad_gyr,
+            "RMSD": rmsd,
+            "PDB_MD": pdb_str,
+            "SASA": mps.calc_sasa("output.pdb"),
+            "3DI": mps.get_3di_sequence("output.pdb"),
+            "P-SEA": mps.get_p_sea_sequence("output.pdb"),
+            "Protein_Blocks": mps.get_protein_blocks_sequence("output.pdb"),
+            "DSSP": mps.get_dssp_sequence("output.pdb"),
+        }
+    finally:
         # Safely remove temporary files
-        for temp_file in ["tmp.pdb", "output.pdb", "md_log.txt"]:
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def bulk_analysis(file, n_jobs=None):
+    df = pd.read_csv(file)
+
+    # Default to the CPUs this job may use, not every core on the node
+    n_cpus = len(os.sched_getaffinity(0))
+    if n_jobs is None:
+        n_jobs = n_cpus
+
+    # Split the CPUs between the workers so their threaded MD does not
+    # oversubscribe the job; spawned workers inherit the environment
+    saved_env = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    os.environ.update({var: str(max(1, n_cpus // n_jobs)) for var in THREAD_ENV_VARS})
+    try:
+        # Entries are independent, so analyse them in parallel; spawn rather than
+        # fork as the parent may already hold a CUDA context from folding
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 mp_context=multiprocessing.get_context("spawn")) as ex:
+            analyses = list(ex.map(_analyze_entry, range(len(df)), df["PDB"]))
+    finally:
+        for var, value in saved_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+    # Add columns for analysis results, one whole column at a time
+    for col in ANALYSIS_COLUMNS:
+        df[col] = [analysis[col] for analysis in analyses]
 
     # Save the updated dataframe to a new csv file
     df.to_csv(f"analyzed_{file}", index=False)